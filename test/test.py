@@ -1,17 +1,18 @@
 import random
 from dataclasses import dataclass
-from typing import Generator, TypedDict, cast
+from functools import cached_property, lru_cache
+from typing import Callable, Generator, TypedDict, cast
 
 import cocotb
 import cocotb.triggers
 import cocotb.utils
 import debugpy
 import numpy as np
+from cocotb.binary import resolve
 from cocotb.clock import Clock
 from cocotb.handle import SimHandleBase
 from cocotb.triggers import ClockCycles, FallingEdge, RisingEdge
 from fxpmath import Fxp
-from fxpmath.utils import twos_complement_repr
 
 DEBUGGING = False
 
@@ -25,7 +26,17 @@ class FixedPointConfiguration(TypedDict):
     n_frac: int
 
 
-@dataclass
+IO_SAMPLE_CONFIG: FixedPointConfiguration = {
+    "signed": True,
+    "n_word": SERIAL_DATA_WIDTH,
+    "n_frac": 0,
+}
+
+# Silent serial sample, read only
+ZERO_IO = Fxp(0, **IO_SAMPLE_CONFIG)
+
+
+@dataclass(frozen=True)
 class Constants(object):
     nTaps: int
     dataWidth: int
@@ -36,35 +47,34 @@ class Constants(object):
     def nCoeffs(self) -> int:
         return (self.nTaps + 1) // 2
 
-    @property
-    def coeffConfig(self) -> FixedPointConfiguration:
-        return {
-            "signed": True,
-            "n_word": self.dataWidth,
-            "n_frac": self.dataWidth - 1,
-        }
-
     @property
     def ioSampleConfig(self) -> FixedPointConfiguration:
-        return {
-            "signed": True,
-            "n_word": SERIAL_DATA_WIDTH,
-            "n_frac": 0,
-        }
+        return IO_SAMPLE_CONFIG
 
-    @property
-    def sampleConfig(self) -> FixedPointConfiguration:
-        return {
-            "signed": True,
-            "n_word": self.dataWidth,
-            "n_frac": 0,
-        }
+    @cached_property
+    def dataMax(self) -> int:
+        return (1 << (self.dataWidth - 1)) - 1
+
+    @cached_property
+    def dataMin(self) -> int:
+        return -(1 << (self.dataWidth - 1))
 
     @property
     def dataSampleShift(self) -> int:
         return SERIAL_DATA_WIDTH - self.dataWidth
 
 
+def twosComplement(value: int, width: int) -> int:
+    """Encode a signed value as an unsigned width bit two's complement field."""
+    return value & ((1 << width) - 1)
+
+
+def signExtend(value: int, width: int) -> int:
+    """Decode a width bit two's complement field into a signed value."""
+    value &= (1 << width) - 1
+    return value - (1 << width) if value >> (width - 1) else value
+
+
 GATE_LEVEL_SIM_PARAMETERS = Constants(
     nTaps=11,
     dataWidth=8,
@@ -77,69 +87,171 @@ def generateConfig(
     consts: Constants,
     clockConfig: int,
     symCoeffs: bool,
-    coeffs: list[Fxp],
+    coeffs: list[int],
+) -> bytes:
+    coeffsRaw = tuple(twosComplement(coeff, consts.dataWidth) for coeff in coeffs)
+    return packConfig(consts, clockConfig, symCoeffs, coeffsRaw)
+
+
+@lru_cache
+def packConfig(
+    consts: Constants,
+    clockConfig: int,
+    symCoeffs: bool,
+    coeffsRaw: tuple[int, ...],
 ) -> bytes:
-    data = 0
+    """Pack the configuration into the bytes sent over SPI.
+    coeffsRaw are the coefficients as unsigned DataWidth bit fields.
+    """
+    nBits = (
+        consts.clockConfigWidth
+        + consts.symCoeffsWidth
+        + consts.dataWidth * len(coeffsRaw)
+    )
+
+    # Built LSB first, then reversed so the SPI transfer starts from the MSB
+    buf = bytearray((nBits + 8) // 8)
     offset = 0
 
-    data |= clockConfig
+    writeBits(buf, offset, clockConfig, consts.clockConfigWidth)
     offset += consts.clockConfigWidth
 
-    data |= symCoeffs << offset
+    writeBits(buf, offset, symCoeffs, consts.symCoeffsWidth)
     offset += consts.symCoeffsWidth
 
-    for coeff in coeffs:
-        data |= (int(cast(int, coeff.val)) & ((1 << consts.dataWidth) - 1)) << offset
+    for coeff in coeffsRaw:
+        writeBits(buf, offset, coeff, consts.dataWidth)
         offset += consts.dataWidth
 
-    byteData = data.to_bytes((offset + 8) // 8, "big")
-    return byteData
+    return bytes(reversed(buf))
 
 
-def FilterResponseGenerator(
-    consts: Constants, symCoeffs: bool, coeffs: list[Fxp]
-) -> Generator[Fxp, Fxp | None, None]:
-    dataMax = Fxp(0, **consts.sampleConfig).set_val(
-        twos_complement_repr((1 << (consts.dataWidth - 1)) - 1, consts.dataWidth),
-        raw=True,
-    )
-    dataMin = Fxp(0, **consts.sampleConfig).set_val(
-        twos_complement_repr(1 << (consts.dataWidth - 1), consts.dataWidth), raw=True
-    )
+def writeBits(buf: bytearray, offset: int, value: int, width: int) -> None:
+    """OR a width bit field into a little endian bit buffer, starting at bit offset."""
+    value = (value & ((1 << width) - 1)) << (offset % 8)
+    i = offset // 8
+    while value:
+        buf[i] |= value & 0xFF
+        value >>= 8
+        i += 1
+
+
+def saturate(consts: Constants, acc: int) -> int:
+    """Convert an accumulator value to an output sample.
+    Removes the fractional bits of the coefficients, saturates to DataWidth and scales to
+    the serial data width.
+    """
+    acc >>= consts.dataWidth - 1
+    if acc > consts.dataMax:
+        acc = consts.dataMax
+    elif acc < consts.dataMin:
+        acc = consts.dataMin
+    return acc << consts.dataSampleShift
 
-    samples = [Fxp(0, **consts.sampleConfig) for _ in range(consts.nTaps)]
-    nCoeffs = (consts.nTaps + 1) // 2
-    assert nCoeffs == len(coeffs)
+
+def firStepSym(
+    consts: Constants,
+    coeffs: np.ndarray,
+    left: np.ndarray,
+    right: np.ndarray,
+    center: int,
+) -> int:
+    """Compute a single filter output with symmetric coefficients.
+    left and right are the pairs of samples sharing each coefficient but the last, newest
+    first and oldest first respectively. center is the middle sample, coeffs are the raw
+    coefficient values.
+    The output is saturated and scaled to the serial data width.
+    """
+    acc = int((left + right) @ coeffs[:-1]) + int(coeffs[-1]) * center
+    return saturate(consts, acc)
+
+
+def firStepAsym(
+    consts: Constants,
+    coeffs: np.ndarray,
+    left: np.ndarray,
+    right: np.ndarray,
+    center: int,
+) -> int:
+    """Compute a single filter output with anti-symmetric coefficients.
+    Arguments are the same as firStepSym.
+    """
+    acc = int((left - right) @ coeffs[:-1]) + int(coeffs[-1]) * center
+    return saturate(consts, acc)
+
+
+def FilterResponseGenerator(
+    consts: Constants,
+    firStep: Callable[[Constants, np.ndarray, np.ndarray, np.ndarray, int], int],
+    coeffs: list[int],
+) -> Generator[int, int | None, None]:
+    """Reference model of the filter, computing each output with firStep.
+    coeffs are the raw SFix<1,DataWidth-1> coefficient values.
+    Samples are sent and responses are yielded as raw serial data width integers.
+    """
+    # Coefficients are constant for the lifetime of the generator
+    coeffRaw = np.array(coeffs, dtype=np.int64)
+    assert consts.nCoeffs == len(coeffRaw)
+
+    # Circular sample buffer, the newest sample is at head
+    samples = np.zeros(consts.nTaps, dtype=np.int64)
+    head = 0
+
+    # Indices of the samples sharing each coefficient, relative to head
+    leftIndex = np.arange(consts.nCoeffs - 1, dtype=np.intp)
+    rightIndex = (consts.nTaps - 1) - leftIndex
+    centerIndex = consts.nTaps // 2
 
     while True:
         # Compute response
-        acc = Fxp(0, **consts.sampleConfig)
-        for i in range(nCoeffs - 1):
-            if symCoeffs:
-                acc += (samples[i] + samples[consts.nTaps - 1 - i]) * coeffs[i]
-            else:
-                acc += (samples[i] - samples[consts.nTaps - 1 - i]) * coeffs[i]
-        acc += coeffs[-1] * samples[consts.nTaps // 2]
-
-        # Convert to output
-        acc = cast(Fxp, np.floor(acc))
-        if acc > dataMax:
-            out = dataMax
-        elif acc < dataMin:
-            out = dataMin
-        else:
-            out = acc
-
-        out <<= consts.dataSampleShift
-        out.resize(**consts.ioSampleConfig)
+        left = samples.take(head + leftIndex, mode="wrap")
+        right = samples.take(head + rightIndex, mode="wrap")
+        center = int(samples[(head + centerIndex) % consts.nTaps])
+        out = firStep(consts, coeffRaw, left, right, center)
 
         # Shift in sample
         sample = yield out
         assert sample is not None
 
-        sample = cast(Fxp, np.floor(sample >> consts.dataSampleShift))
-        samples[1 : consts.nTaps] = samples[0 : consts.nTaps - 1]
-        samples[0] = sample
+        head = (head - 1) % consts.nTaps
+        samples[head] = sample >> consts.dataSampleShift
+
+
+def SymFilterResponseGenerator(
+    consts: Constants, coeffs: list[int]
+) -> Generator[int, int | None, None]:
+    """Reference model of the filter with symmetric coefficients."""
+    return FilterResponseGenerator(consts, firStepSym, coeffs)
+
+
+def AsymFilterResponseGenerator(
+    consts: Constants, coeffs: list[int]
+) -> Generator[int, int | None, None]:
+    """Reference model of the filter with anti-symmetric coefficients."""
+    return FilterResponseGenerator(consts, firStepAsym, coeffs)
+
+
+def filterResponse(
+    consts: Constants, symCoeffs: bool, coeffs: list[int], samples: list[int]
+) -> list[int]:
+    """Compute the expected responses to a whole sequence of samples at once.
+    Starts from an empty filter, the nth response includes the nth sample.
+    """
+    # Expand the folded coefficients to the full impulse response
+    coeffRaw = np.array(coeffs, dtype=np.int64)
+    assert consts.nCoeffs == len(coeffRaw)
+    h = np.empty(consts.nTaps, dtype=np.int64)
+    h[: consts.nCoeffs] = coeffRaw
+    h[consts.nCoeffs :] = coeffRaw[-2::-1] if symCoeffs else -coeffRaw[-2::-1]
+
+    x = np.array(samples, dtype=np.int64) >> consts.dataSampleShift
+    y = np.convolve(x, h)[: len(x)]
+
+    # Same conversion as saturate, for every output
+    y >>= consts.dataWidth - 1
+    np.clip(y, consts.dataMin, consts.dataMax, out=y)
+    y <<= consts.dataSampleShift
+    return y.tolist()
 
 
 async def resetCore(dut: SimHandleBase) -> None:
@@ -158,6 +270,10 @@ class SPIModel(object):
         self.cs.value = 1
         self.mosi.value = 0
 
+        # Triggers are reused for every bit
+        self.spiClkRising = RisingEdge(self.spiClk)
+        self.spiClkFalling = FallingEdge(self.spiClk)
+
         # 1MHz clock
         clock = Clock(dut.spiClk, 500, units="ns")
         cocotb.start_soon(clock.start())
@@ -167,15 +283,16 @@ class SPIModel(object):
         starts from MSB of first byte.
         """
 
-        await RisingEdge(self.spiClk)
+        bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8), bitorder="big")
+
+        await self.spiClkRising
         self.cs.value = 0
 
-        for byte in data:
-            for j in range(8):
-                await FallingEdge(self.spiClk)
-                self.mosi.value = (byte >> (8 - 1 - j)) & 0x1
+        for bit in bits.tolist():
+            await self.spiClkFalling
+            self.mosi.value = bit
 
-        await FallingEdge(self.spiClk)
+        await self.spiClkFalling
         self.cs.value = 1
         self.mosi.value = 0
 
@@ -191,31 +308,40 @@ class I2SModel(object):
 
         self.adc.value = 0
 
+        # Triggers are reused for every bit
+        self.lrckRising = RisingEdge(self.lrck)
+        self.sclkRising = RisingEdge(self.sclk)
+        self.sclkFalling = FallingEdge(self.sclk)
+
     async def sendAdc(self, value: Fxp) -> None:
-        await RisingEdge(self.lrck)  # Only send data on high lrck
+        valueRaw = int(cast(int, value.val))
+        bits = [
+            (valueRaw >> (SERIAL_DATA_WIDTH - 1 - i)) & 0x1
+            for i in range(SERIAL_DATA_WIDTH)
+        ]
+
+        await self.lrckRising  # Only send data on high lrck
         await cocotb.triggers.Timer(1, units="ps")  # type: ignore
 
-        valueRaw = int(cast(int, value.val))
-        for i in range(SERIAL_DATA_WIDTH):
-            await FallingEdge(self.sclk)
-            self.adc.value = (valueRaw >> (SERIAL_DATA_WIDTH - 1 - i)) & 0x1
+        for bit in bits:
+            await self.sclkFalling
+            self.adc.value = bit
 
-        await FallingEdge(self.sclk)
+        await self.sclkFalling
         self.adc.value = 0
 
-    async def readDac(self) -> Fxp:
-        await RisingEdge(self.lrck)  # Only read on high lrck
-        await RisingEdge(self.sclk)  # Skip first sample pulse
+    async def readDac(self) -> int:
+        await self.lrckRising  # Only read on high lrck
+        await self.sclkRising  # Skip first sample pulse
 
-        valueRaw = 0
-        for _ in range(SERIAL_DATA_WIDTH):
-            await RisingEdge(self.sclk)
-            valueRaw = (valueRaw << 1) | int(self.dac.value)
+        bits = [""] * SERIAL_DATA_WIDTH
+        for i in range(SERIAL_DATA_WIDTH):
+            await self.sclkRising
+            bits[i] = self.dac.value.binstr
 
-        return Fxp(
-            0,
-            **self.consts.ioSampleConfig,
-        ).set_val(twos_complement_repr(valueRaw, SERIAL_DATA_WIDTH), raw=True)
+        # Resolve X/Z and convert once for the whole frame, MSB first
+        valueRaw = int(resolve("".join(bits)), 2)
+        return signExtend(valueRaw, SERIAL_DATA_WIDTH)
 
 
 @cocotb.test
@@ -245,7 +371,7 @@ async def test_project(dut: SimHandleBase):
 
     clockConfig = 0
     symCoeffs = True
-    coeffs = [Fxp(0, **consts.coeffConfig) for _ in range(consts.nCoeffs)]
+    coeffs = [0] * consts.nCoeffs
 
     def genConfigLocal() -> bytes:
         return generateConfig(consts, clockConfig, symCoeffs, coeffs)
@@ -294,13 +420,14 @@ async def test_project(dut: SimHandleBase):
     dut._log.info("Test Impulse Response")
     await resetCore(dut)
 
-    filterRespGen = FilterResponseGenerator(consts, symCoeffs, coeffs)
-    filterRespGen.send(None)
-
     clockConfig = 0
     for i in range(consts.nCoeffs):
         rand = random.randint(0, 0xFFF)
-        coeffs[i].set_val(twos_complement_repr(rand, consts.dataWidth), raw=True)
+        coeffs[i] = signExtend(rand, consts.dataWidth)
+
+    # The generator snapshots the coefficients, create it once they are set
+    filterRespGen = SymFilterResponseGenerator(consts, coeffs)
+    filterRespGen.send(None)
 
     await spi.sendData(genConfigLocal())
 
@@ -308,9 +435,7 @@ async def test_project(dut: SimHandleBase):
     await i2s.sendAdc(adcData)
 
     for i in range(consts.nTaps * 2):
-        resp = filterRespGen.send(
-            adcData if i == 0 else Fxp(0, **consts.ioSampleConfig)
-        )
+        resp = filterRespGen.send(int(cast(int, adcData.val)) if i == 0 else 0)
         dacData = await i2s.readDac()
         assert (
             dacData == resp
@@ -323,31 +448,32 @@ async def test_project(dut: SimHandleBase):
     await resetCore(dut)
     await spi.sendData(genConfigLocal())
 
-    adcData = Fxp(random.randint(-0x800000, 0x7FFFFF), **consts.ioSampleConfig)
-    await i2s.sendAdc(adcData)
+    # Random samples, followed by zeros to flush the filter
+    adcSamples = [
+        random.randint(-0x800000, 0x7FFFFF) for _ in range(consts.nTaps * 2 + 1)
+    ] + [0] * consts.nTaps
+    respSamples = filterResponse(consts, symCoeffs, coeffs, adcSamples)
 
-    for i in range(consts.nTaps * 2):
-        resp = filterRespGen.send(adcData)
+    await i2s.sendAdc(Fxp(adcSamples[0], **consts.ioSampleConfig))
 
-        adcData = Fxp(random.randint(-0x800000, 0x7FFFFF), **consts.ioSampleConfig)
+    for i in range(consts.nTaps * 2):
+        adcData = Fxp(adcSamples[i + 1], **consts.ioSampleConfig)
         adcTask = cocotb.start_soon(i2s.sendAdc(adcData))
 
         dacData = await i2s.readDac()
         await adcTask
 
+        resp = respSamples[i]
         assert (
             dacData == resp
         ), f"Random response incorrect, at {i} should be {resp} not {dacData}"
 
     for i in range(consts.nTaps + 1):
-        resp = filterRespGen.send(
-            adcData if i == 0 else Fxp(0, **consts.ioSampleConfig)
-        )
-
-        adcTask = cocotb.start_soon(i2s.sendAdc(Fxp(0, **consts.ioSampleConfig)))
+        adcTask = cocotb.start_soon(i2s.sendAdc(ZERO_IO))
         dacData = await i2s.readDac()
         await adcTask
 
+        resp = respSamples[consts.nTaps * 2 + i]
         assert (
             dacData == resp
         ), f"Random fading response incorrect, at {i} should be {resp} not {dacData}"
@@ -361,16 +487,14 @@ async def test_project(dut: SimHandleBase):
     symCoeffs = False
     await spi.sendData(genConfigLocal())
 
-    filterRespGen = FilterResponseGenerator(consts, symCoeffs, coeffs)
+    filterRespGen = AsymFilterResponseGenerator(consts, coeffs)
     filterRespGen.send(None)
 
     adcData = Fxp(1 << 22, **consts.ioSampleConfig)
     await i2s.sendAdc(adcData)
 
     for i in range(consts.nTaps * 2):
-        resp = filterRespGen.send(
-            adcData if i == 0 else Fxp(0, **consts.ioSampleConfig)
-        )
+        resp = filterRespGen.send(int(cast(int, adcData.val)) if i == 0 else 0)
         dacData = await i2s.readDac()
         assert (
             dacData == resp
@@ -383,31 +507,32 @@ async def test_project(dut: SimHandleBase):
     await resetCore(dut)
     await spi.sendData(genConfigLocal())
 
-    adcData = Fxp(random.randint(-0x800000, 0x7FFFFF), **consts.ioSampleConfig)
-    await i2s.sendAdc(adcData)
+    # Random samples, followed by zeros to flush the filter
+    adcSamples = [
+        random.randint(-0x800000, 0x7FFFFF) for _ in range(consts.nTaps * 2 + 1)
+    ] + [0] * consts.nTaps
+    respSamples = filterResponse(consts, symCoeffs, coeffs, adcSamples)
 
-    for i in range(consts.nTaps * 2):
-        resp = filterRespGen.send(adcData)
+    await i2s.sendAdc(Fxp(adcSamples[0], **consts.ioSampleConfig))
 
-        adcData = Fxp(random.randint(-0x800000, 0x7FFFFF), **consts.ioSampleConfig)
+    for i in range(consts.nTaps * 2):
+        adcData = Fxp(adcSamples[i + 1], **consts.ioSampleConfig)
         adcTask = cocotb.start_soon(i2s.sendAdc(adcData))
 
         dacData = await i2s.readDac()
         await adcTask
 
+        resp = respSamples[i]
         assert (
             dacData == resp
         ), f"Asymetric random response incorrect, at {i} should be {resp} not {dacData}"
 
     for i in range(consts.nTaps + 1):
-        resp = filterRespGen.send(
-            adcData if i == 0 else Fxp(0, **consts.ioSampleConfig)
-        )
-
-        adcTask = cocotb.start_soon(i2s.sendAdc(Fxp(0, **consts.ioSampleConfig)))
+        adcTask = cocotb.start_soon(i2s.sendAdc(ZERO_IO))
         dacData = await i2s.readDac()
         await adcTask
 
+        resp = respSamples[consts.nTaps * 2 + i]
         assert (
             dacData == resp
         ), f"Asymetric random fading response incorrect, at {i} should be {resp} not {dacData}"